@@ -0,0 +1,129 @@
+"""Estimate and correct small translations between images.
+
+Offsets are found by phase correlation. A coarse estimate is made on a
+downsampled pyramid level, then refined on a crop of the full-resolution
+images, so the cost stays low even for 4K frames.
+
+Only small offsets are expected. Estimates that are large or have a low
+correlation response (e.g. between unrelated images) are rejected.
+"""
+
+import enable_exr  # noqa: F401
+import cv2
+import numpy
+from metrics import LUMINANCE, _tonemap
+
+# Downsample until images are no larger than this for the coarse estimate
+COARSE_SIZE = 512
+# Size of the full-resolution crop used to refine the estimate
+REFINE_SIZE = 256
+# Images smaller than this in either dimension are not aligned
+MIN_SIZE = 16
+# Estimates with a larger offset or a lower response are rejected
+MAX_OFFSET = 16
+MIN_RESPONSE = 0.2
+
+
+def _luminance(a, b):
+    """Tonemapped luminance of a and b, for correlation.
+
+    Both are scaled so the mean of a is 1 before tonemapping, so that
+    bright HDR values neither dominate nor saturate, whatever the
+    exposure.
+    """
+    weights = numpy.append(LUMINANCE, 0).reshape(1, 4)
+    a, b = (cv2.transform(i, weights) for i in (a, b))
+    mean = cv2.mean(a)[0]
+    scale = 1 / mean if mean > 0 else 1
+    return [_tonemap(i[..., numpy.newaxis] * scale)[..., 0] for i in (a, b)]
+
+
+def _correlate(a, b):
+    """Return (dx, dy, response) from phase correlation."""
+    window = cv2.createHanningWindow((a.shape[1], a.shape[0]), cv2.CV_32F)
+    (dx, dy), response = cv2.phaseCorrelate(a, b, window)
+    return dx, dy, response
+
+
+def _crop(image, x, y, width, height):
+    return image[slice(y, y + height), slice(x, x + width)]
+
+
+def _textured_tile(image, size):
+    """Return (x, y) of the size x size tile of image with the most variance.
+
+    Phase correlation on a flat region is dominated by noise, so the
+    refinement crop should contain as much detail as possible.
+    """
+    height, width = image.shape[:2]
+    rows, cols = max(1, height // size), max(1, width // size)
+    tile_h, tile_w = min(size, height), min(size, width)
+    tiles = _crop(image, 0, 0, cols * tile_w, rows * tile_h)
+    tiles = tiles.reshape(rows, tile_h, cols, tile_w)
+    row, col = numpy.unravel_index(numpy.argmax(tiles.var(axis=(1, 3))), (rows, cols))
+    return col * tile_w, row * tile_h
+
+
+def shift(image, offset):
+    """Translate image by offset (dx, dy), filling with zeros."""
+    dx, dy = offset
+    if dx == dy == 0:
+        return image
+    height, width = image.shape[:2]
+    matrix = numpy.float32([[1, 0, dx], [0, 1, dy]])
+    return cv2.warpAffine(
+        image,
+        matrix,
+        (width, height),
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=0,
+    )
+
+
+def estimate_offset(a, b, subpixel=False):
+    """Estimate the translation (dx, dy) of b relative to a.
+
+    Shifting b by (-dx, -dy) aligns it with a. Offsets are rounded to
+    whole pixels unless subpixel is set. Returns (0, 0) if the images
+    are too small or no reliable small offset is found.
+    """
+    if min(a.shape[:2]) < MIN_SIZE:
+        return 0, 0
+    a, b = _luminance(a, b)
+
+    # Coarse estimate on a downsampled level
+    small_a, small_b = a, b
+    level = 0
+    while max(small_a.shape) > COARSE_SIZE and min(small_a.shape) >= 2 * MIN_SIZE:
+        small_a, small_b = cv2.pyrDown(small_a), cv2.pyrDown(small_b)
+        level += 1
+    cx, cy, response = _correlate(small_a, small_b)
+    cx, cy = cx * 2**level, cy * 2**level
+    if response < MIN_RESPONSE or max(abs(cx), abs(cy)) > MAX_OFFSET:
+        return 0, 0
+
+    if level > 0:
+        # Refine at full resolution, on the most textured tile of the
+        # coarsely aligned images. Pick the tile at the coarse level,
+        # where it's cheap to search.
+        dx, dy = round(cx), round(cy)
+        tile = REFINE_SIZE // 2**level
+        x, y = (i * 2**level for i in _textured_tile(small_a, tile))
+        # Only shift a crop of b, with enough margin for the offset
+        margin = MAX_OFFSET + 1
+        x0, y0 = max(0, x - margin), max(0, y - margin)
+        size = REFINE_SIZE + x - x0 + margin, REFINE_SIZE + y - y0 + margin
+        shifted = shift(_crop(b, x0, y0, *size), (-dx, -dy))
+        rx, ry, response = _correlate(
+            _crop(a, x, y, REFINE_SIZE, REFINE_SIZE),
+            _crop(shifted, x - x0, y - y0, REFINE_SIZE, REFINE_SIZE),
+        )
+        # The coarse estimate is accurate to about half a coarse pixel,
+        # so a larger correction means the refinement went wrong.
+        if response >= MIN_RESPONSE and max(abs(rx), abs(ry)) <= 2 ** (level - 1):
+            cx, cy = dx + rx, dy + ry
+
+    if not subpixel:
+        return round(cx), round(cy)
+    return cx, cy
@@ -0,0 +1,173 @@
+"""Compare directories of images.
+
+Pairs are compared in worker processes, which also write small
+thumbnails of the left, right and diff images, and any exported images
+or video frames. Results are saved as a JSON report alongside the
+thumbnails, so they can be reviewed later without recomputing anything.
+"""
+
+import enable_exr  # noqa: F401
+import collections
+import concurrent.futures
+import cv2
+import export
+import json
+import numpy
+import os
+from images import Images
+
+REPORT_NAME = "report.json"
+THUMBNAIL_SIZE = 128
+THUMBNAIL_NAMES = ["left", "right", "diff"]
+
+
+def find_pairs(dir1, dir2):
+    """Match up the files in two directories by name.
+
+    Returns (pairs, unmatched): (file1, file2) for each file present in
+    both directories, and the paths of files present in only one.
+    """
+    files1, files2 = (
+        {n for n in os.listdir(d) if os.path.isfile(os.path.join(d, n))}
+        for d in (dir1, dir2)
+    )
+    pairs = [
+        (os.path.join(dir1, n), os.path.join(dir2, n)) for n in sorted(files1 & files2)
+    ]
+    unmatched = [os.path.join(dir1, n) for n in sorted(files1 - files2)] + [
+        os.path.join(dir2, n) for n in sorted(files2 - files1)
+    ]
+    return pairs, unmatched
+
+
+def _thumbnail(image, scale):
+    height, width = image.shape[:2]
+    size = max(1, round(width * scale)), max(1, round(height * scale))
+    small = cv2.resize(
+        numpy.ascontiguousarray(image[..., :3]), size, interpolation=cv2.INTER_AREA
+    )
+    return (numpy.clip(small, 0, 1) * 255).astype(numpy.uint8)
+
+
+def _compare(job):
+    """Compare one pair, writing thumbnails and exports. Runs in a worker process.
+
+    Returns (result, video frame or None).
+    """
+    index, file1, file2, report_dir, export_filename, options = job
+    result = {"file1": file1, "file2": file2}
+    try:
+        images = Images(file1, file2, **options)
+    except Exception as e:
+        result["error"] = str(e)
+        return result, None
+
+    result["max_diff"] = float(images.max_diff)
+    result["metrics"] = images.metrics
+    result["offset"] = images.offset
+
+    if report_dir is not None:
+        left, right, diff = images.cv_images[:3]
+        if images.max_diff > 0:
+            # Normalize the diff so small differences are visible
+            diff = diff / images.max_diff
+        scale = min(1.0, THUMBNAIL_SIZE / max(left.shape[:2]))
+        result["thumbnails"] = []
+        for name, image in zip(THUMBNAIL_NAMES, [left, right, diff]):
+            filename = f"{index:04d}-{name}.png"
+            export.imwrite(os.path.join(report_dir, filename), _thumbnail(image, scale))
+            result["thumbnails"].append(filename)
+
+    frame = None
+    if export_filename and export.is_video(export_filename):
+        frame = export.frame(images)
+    elif export_filename:
+        export.export_images(images, export.pair_filename(export_filename, file1))
+    return result, frame
+
+
+def _bounded_map(executor, function, jobs, limit):
+    """Like executor.map, but with at most limit jobs in flight.
+
+    executor.map submits every job at once, so finished results (such as
+    video frames) pile up in memory if they are consumed more slowly
+    than they're produced.
+    """
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(executor.submit(function, job))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _run(jobs, processes, export_filename, fps):
+    """Run _compare on jobs in parallel, streaming any video frames to the
+    export file in order. Returns the results."""
+    video = None
+    if export_filename and export.is_video(export_filename):
+        video = export.VideoWriter(export_filename, fps)
+    limit = 2 * (processes or os.cpu_count() or 1)
+    results = []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            for result, frame in _bounded_map(executor, _compare, jobs, limit):
+                results.append(result)
+                if frame is not None:
+                    video.write(frame)
+    finally:
+        if video is not None:
+            video.release()
+    return results
+
+
+def run_batch(
+    pairs,
+    report_dir,
+    processes=None,
+    export_filename=None,
+    fps=24,
+    unmatched=(),
+    **options,
+):
+    """Compare pairs in parallel, writing thumbnails and a report to report_dir.
+
+    If export_filename is given, normalized images (or video frames, for
+    a video file) are exported as each pair is compared. unmatched files
+    (see find_pairs) are listed in the report. options are passed to
+    Images. Returns the report.
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    jobs = [
+        (i, file1, file2, report_dir, export_filename, options)
+        for i, (file1, file2) in enumerate(pairs)
+    ]
+    results = _run(jobs, processes, export_filename, fps)
+
+    report = {"options": options, "results": results, "unmatched": list(unmatched)}
+    with open(os.path.join(report_dir, REPORT_NAME), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def export_report(report, export_filename, fps=24, processes=None):
+    """Export the pairs of an existing report.
+
+    Reports only store summaries, so the images are decoded again.
+    """
+    jobs = [
+        (i, r["file1"], r["file2"], None, export_filename, report["options"])
+        for i, r in enumerate(report["results"])
+        if "error" not in r
+    ]
+    _run(jobs, processes, export_filename, fps)
+
+
+def load_report(report_dir):
+    with open(os.path.join(report_dir, REPORT_NAME)) as f:
+        return json.load(f)
+
+
+def is_report(path):
+    return os.path.isfile(os.path.join(path, REPORT_NAME))
@@ -0,0 +1,124 @@
+"""Export normalized images and diffs to files.
+
+Pairs are written as images. Batches can also be written as a video
+with one side-by-side frame per pair; the batch pipeline prepares the
+frames and passes them to a VideoWriter.
+"""
+
+import enable_exr  # noqa: F401
+import cv2
+import numpy
+import os
+
+NAMES = ["left", "right", "diff"]
+# FourCC codes for supported video formats, by extension
+VIDEO_CODECS = {".mp4": "mp4v", ".avi": "MJPG"}
+
+
+def is_video(filename):
+    return os.path.splitext(filename)[1].lower() in VIDEO_CODECS
+
+
+def check_filename(filename, allow_video=False):
+    """Raise ValueError if filename has an extension we can't export to, or
+    is in a directory that doesn't exist."""
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        raise ValueError(f"{filename}: no such directory")
+    if is_video(filename):
+        if not allow_video:
+            raise ValueError(f"{filename}: videos can only be exported for batches")
+    elif not cv2.haveImageWriter(filename):
+        raise ValueError(f"{filename}: unsupported image format")
+
+
+def normalized(images):
+    """Return left, right and diff images, normalized as in the viewer.
+
+    Images are scaled as by Images.normalize() and the diff as by
+    Images.normalize_diff(). Constant images are left unscaled.
+    """
+    with numpy.errstate(divide="ignore"):
+        scale, offset = images.normalization()
+        diff_scale = images.diff_normalization() if images.has_diff else 1.0
+    if not numpy.isfinite(scale):
+        scale, offset = 1.0, 0.0
+    if not numpy.isfinite(diff_scale):
+        diff_scale = 1.0
+
+    result = [i * scale + offset for i in images.cv_images[:2]]
+    if images.has_diff:
+        result.append(images.cv_images[2] * diff_scale)
+    return result
+
+
+def _to_8bit(image):
+    return (numpy.clip(image[..., :3], 0, 1) * 255).astype(numpy.uint8)
+
+
+def imwrite(filename, image):
+    """Like cv2.imwrite, but raise RuntimeError if the image isn't written."""
+    if not cv2.imwrite(filename, image):
+        raise RuntimeError(f"{filename}: can't write image")
+
+
+def _write(filename, image):
+    if os.path.splitext(filename)[1].lower() == ".exr":
+        # Keep full float precision. Alpha is dropped, as for other
+        # formats, since normalizing (or diffing) it makes it meaningless.
+        imwrite(filename, numpy.ascontiguousarray(image[..., :3]))
+    else:
+        imwrite(filename, _to_8bit(image))
+
+
+def export_images(images, filename):
+    """Write normalized images to filename, with -left, -right and -diff
+    suffixes added before the extension."""
+    check_filename(filename)
+    stem, ext = os.path.splitext(filename)
+    for name, image in zip(NAMES, normalized(images)):
+        _write(f"{stem}-{name}{ext}", image)
+
+
+def pair_filename(filename, file1):
+    """Export filename for one pair of a batch, with the pair's name added."""
+    stem, ext = os.path.splitext(filename)
+    pair_name = os.path.splitext(os.path.basename(file1))[0]
+    return f"{stem}-{pair_name}{ext}"
+
+
+def frame(images):
+    """Return a video frame with normalized images side by side."""
+    return numpy.hstack([_to_8bit(i) for i in normalized(images)])
+
+
+class VideoWriter:
+    """Write frames to a video, resizing them to match the first frame.
+
+    The cv2.VideoWriter is created when the first frame arrives, since
+    that's when the size is known.
+    """
+
+    def __init__(self, filename, fps):
+        self._filename = filename
+        self._fps = fps
+        self._writer = None
+
+    def write(self, frame):
+        size = frame.shape[1], frame.shape[0]
+        if self._writer is None:
+            codec = VIDEO_CODECS[os.path.splitext(self._filename)[1].lower()]
+            self._writer = cv2.VideoWriter(
+                self._filename, cv2.VideoWriter_fourcc(*codec), self._fps, size
+            )
+            if not self._writer.isOpened():
+                raise RuntimeError(f"{self._filename}: can't write {codec} video")
+            self._size = size
+        elif size != self._size:
+            # Video frames must all be the same size
+            frame = cv2.resize(frame, self._size, interpolation=cv2.INTER_AREA)
+        self._writer.write(frame)
+
+    def release(self):
+        if self._writer is not None:
+            self._writer.release()
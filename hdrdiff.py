@@ -1,4 +1,6 @@
 import argparse
+import batch
+import export
 import os
 import sys
 import qt
@@ -26,8 +28,15 @@ def position(evt):
         return evt.position()
 
 
+def set_text(label, text):
+    """Set label text, skipping the relayout if it hasn't changed."""
+    if label.text() != text:
+        label.setText(text)
+
+
 class ImageView(qt.QGraphicsView):
     imageMouseOver = qt.Signal(qt.QPoint)
+    imageClicked = qt.Signal(qt.QPoint)
 
     def __init__(self, images, parent=None, **kwargs):
         scene = qt.QGraphicsScene()
@@ -52,8 +61,31 @@ class ImageView(qt.QGraphicsView):
 
         images.imageChanged.connect(update_mouseover)
 
+        # Mouse moves can arrive much faster than the display updates,
+        # so only probe the latest position once per refresh.
+        self._probe_timer = qt.QTimer(self)
+        self._probe_timer.setSingleShot(True)
+        self._probe_timer.setInterval(int(1000 / self._refresh_rate()))
+        self._probe_timer.timeout.connect(update_mouseover)
+
+        # Outline differing tiles. As a child of the pixmap item, this
+        # follows pan and zoom automatically.
+        path = qt.QPainterPath()
+        for rect in images.differing_blocks():
+            path.addRect(qt.QRectF(*rect))
+        self._blocks_item = qt.QGraphicsPathItem(path, self._item)
+        pen = qt.QPen(qt.Qt.red)
+        pen.setCosmetic(True)
+        self._blocks_item.setPen(pen)
+        self._blocks_item.setVisible(False)
+
+        self._pin_markers = []
         self._drag_state = None
 
+    def _refresh_rate(self):
+        screen = qt.QGuiApplication.primaryScreen()
+        return screen.refreshRate() if screen and screen.refreshRate() > 0 else 60
+
     @property
     def _transform(self):
         return self._item.transform()
@@ -62,12 +94,15 @@ class ImageView(qt.QGraphicsView):
     def _transform(self, t):
         self._item.setTransform(t)
 
-    def _emit_mouse_over(self, point):
+    def _image_point(self, point):
         mapped = self._item.mapFromScene(point)
         # QPointF.toPoint() rounds to nearest integer which is not
         # helpful if we're using the result as pixel
         # coordinates. Truncate the coordinates instead.
-        self.imageMouseOver.emit(qt.QPoint(int(mapped.x()), int(mapped.y())))
+        return qt.QPoint(int(mapped.x()), int(mapped.y()))
+
+    def _emit_mouse_over(self, point):
+        self.imageMouseOver.emit(self._image_point(point))
 
     def resizeEvent(self, evt):
         super().resizeEvent(evt)
@@ -99,16 +134,38 @@ class ImageView(qt.QGraphicsView):
                 self._transform = transform.pan(
                     *self._drag_state, (position(evt).x(), position(evt).y())
                 )
-        else:
-            self._emit_mouse_over(position(evt))
+        elif not self._probe_timer.isActive():
+            self._probe_timer.start()
 
     def mouseReleaseEvent(self, evt):
+        if self._drag_state is None and evt.button() == qt.Qt.LeftButton:
+            # Click without dragging
+            self.imageClicked.emit(self._image_point(position(evt)))
         self._drag_state = None
         self.setCursor(qt.Qt.CursorShape.ArrowCursor)
 
     def reset_view(self):
         self._transform = transform.fit(self._image_dims, dims(self.sceneRect()))
 
+    def zoom_to_rect(self, rect):
+        """Zoom to fit an (x, y, width, height) region of the image."""
+        self._transform = transform.fit_rect(rect, dims(self.sceneRect()))
+
+    def add_pin_marker(self, point):
+        marker = qt.QGraphicsRectItem(point.x(), point.y(), 1, 1, self._item)
+        pen = qt.QPen(qt.Qt.yellow)
+        pen.setCosmetic(True)
+        marker.setPen(pen)
+        self._pin_markers.append(marker)
+
+    def clear_pin_markers(self):
+        for marker in self._pin_markers:
+            self.scene().removeItem(marker)
+        self._pin_markers = []
+
+    def toggle_diff_blocks(self):
+        self._blocks_item.setVisible(not self._blocks_item.isVisible())
+
     def zoom_in(self):
         self._transform = transform.zoom(
             self._transform,
@@ -155,10 +212,7 @@ def info_text(point, images):
         except IndexError:
             # No dims for diff
             description = f"{images.descriptions[i]}"
-        try:
-            pixel = images.cv_images[i][y][x]
-        except IndexError:
-            pixel = (0, 0, 0, 0)
+        pixel = images.sample(i, [(x, y)])[0]
         return f"""{"<b>" if selected else ""}{images.image_names[i]}
 &nbsp;&nbsp;{description}
 R: {pixel[2]:g}
@@ -169,50 +223,34 @@ A: {pixel[3]:g}
 """
 
     return (
-        f"{x}, {y}\n\n"
+        f"{x}, {y + images.row_offset}\n\n"
         + "\n\n".join(image_string(i) for i in range(len(images.cv_images)))
     ).replace("\n", "<br>")
 
 
-def console_diff(images):
-    if not images.has_diff or images.max_diff == 0:
-        return 0
-
-    print(f"Maximum diff: {images.max_diff}")
-    return 1
-
-
-def get_file2(args):
-    # With hdrdiff <file> <dir>, look for a matching filename in the
-    # directory (like normal diff)
-    if args.file2 and os.path.isdir(args.file2):
-        return os.path.join(args.file2, os.path.basename(args.file1))
-    else:
-        return args.file2
+def pinned_text(points, images):
+    """Values of the selected image (or channel) at pinned points."""
+    if not points:
+        return ""
+    i = images.selected_image
+    # Gather all pinned pixels at once
+    pixels = images.sample(i, points)
+    channels = images.channel or "RGBA"
 
+    def pixel_string(pixel):
+        return " ".join(f"{c}: {pixel['BGRA'.index(c)]:g}" for c in channels)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("file1")
-    parser.add_argument("file2", nargs="?")
-    parser.add_argument(
-        "-n", "--no-gui", help="Print diff information and exit.", action="store_true"
-    )
-    parser.add_argument(
-        "-x",
-        "--exit-if-same",
-        help="Only show GUI if images differ.",
-        action="store_true",
+    return "<br>".join(
+        [f"<b>Pinned ({images.image_names[i]})</b>"]
+        + [
+            f"{x}, {y + images.row_offset}&nbsp;&nbsp;{pixel_string(pixel)}"
+            for (x, y), pixel in zip(points, pixels)
+        ]
     )
-    args = parser.parse_args()
 
-    images = Images(args.file1, get_file2(args))
-    if args.no_gui:
-        sys.exit(console_diff(images))
-    if args.exit_if_same and images.has_diff and images.max_diff == 0:
-        sys.exit(0)
 
-    app = qt.QApplication([])
+def viewer_window(images):
+    """Create a window for viewing and comparing images."""
     window = qt.QWidget()
 
     image_info = qt.QLabel(parent=window)
@@ -221,9 +259,35 @@ if __name__ == "__main__":
     # width is not ideal, but good enough for now.
     image_info.setFixedWidth(200)
     image_info.setWordWrap(True)
+    pinned_info = qt.QLabel(parent=window)
+    pinned_info.setTextFormat(qt.Qt.RichText)
+    pinned_info.setFixedWidth(200)
+    pinned_info.setWordWrap(True)
     shortcut_info = qt.QLabel(parent=window)
     view = ImageView(images, parent=window)
-    view.imageMouseOver.connect(lambda p: image_info.setText(info_text(p, images)))
+    view.imageMouseOver.connect(lambda p: set_text(image_info, info_text(p, images)))
+
+    # Pinned sample points, as (x, y)
+    pins = []
+
+    def update_pins():
+        set_text(pinned_info, pinned_text(pins, images))
+
+    def add_pin(point):
+        if not images.contains(point.x(), point.y()):
+            # Clicked on the background
+            return
+        pins.append((point.x(), point.y()))
+        view.add_pin_marker(point)
+        update_pins()
+
+    def clear_pins():
+        pins.clear()
+        view.clear_pin_markers()
+        update_pins()
+
+    view.imageClicked.connect(add_pin)
+    images.imageChanged.connect(update_pins)
     scale = NumberWidget(1.0, min_value=0, parent=window)
     scale.valueChanged.connect(images.set_scale)
     offset = NumberWidget(0.0)
@@ -280,12 +344,12 @@ if __name__ == "__main__":
                     ),
                 ]
             ),
-            VBox(children=[image_info, shortcut_info]),
+            VBox(children=[image_info, pinned_info, shortcut_info]),
         ],
     )
 
     def toggle_normalize():
-        if images.selected_image == 2:
+        if images.selected_image >= 2:
             if diff_scale.value == 1.0:
                 do_normalize_diff()
             else:
@@ -296,6 +360,11 @@ if __name__ == "__main__":
             else:
                 do_reset()
 
+    def zoom_to_worst():
+        worst = images.worst_regions(1)
+        if worst:
+            view.zoom_to_rect(worst[0][0])
+
     # Shortcuts
     shortcuts = [
         Shortcut(window, *s)
@@ -307,6 +376,8 @@ if __name__ == "__main__":
             ),
             ("Zoom Out", view.zoom_out, [qt.Qt.CTRL | qt.Qt.Key_Minus]),
             ("Reset Zoom", view.reset_view, [qt.Qt.CTRL | qt.Qt.Key_0]),
+            ("Zoom to Largest Diff", zoom_to_worst, [qt.Qt.Key_W]),
+            ("Toggle Diff Tiles", view.toggle_diff_blocks, [qt.Qt.Key_T]),
             (
                 "Toggle Single-Channel View",
                 images.view_channel,
@@ -315,11 +386,302 @@ if __name__ == "__main__":
             ("View Left Image", lambda: images.select_image(0), [qt.Qt.Key_1]),
             ("View Right Image", lambda: images.select_image(1), [qt.Qt.Key_2]),
             ("View Diff", lambda: images.select_image(2), [qt.Qt.Key_3]),
+            ("View SSIM Error", lambda: images.select_image(3), [qt.Qt.Key_4]),
+            (
+                "View Perceptual Error",
+                lambda: images.select_image(4),
+                [qt.Qt.Key_5],
+            ),
             ("Normalize/Reset", toggle_normalize, [qt.Qt.Key_N]),
+            ("Clear Pinned Samples", clear_pins, [qt.Qt.Key_C]),
             ("Quit", window.close, [qt.Qt.Key_Q, qt.Qt.Key_Escape]),
         ]
     ]
     shortcut_info.setText("Shortcuts:\n" + "\n".join(s.description for s in shortcuts))
+    # Keep shortcuts alive as long as the window
+    window.shortcuts = shortcuts
+    return window
+
+
+class ReviewWindow(qt.QTableWidget):
+    """Table of batch results, with thumbnails. Double-click to view a pair."""
+
+    COLUMNS = ["Left", "Right", "Diff", "Name", "Max Diff"]
+
+    def __init__(self, report, report_dir, parent=None):
+        super().__init__(len(report["results"]), len(self.COLUMNS), parent=parent)
+        self._report = report
+        # Open viewer windows, by index in the report
+        self._viewers = {}
+
+        self.setHorizontalHeaderLabels(self.COLUMNS)
+        self.setIconSize(qt.QSize(batch.THUMBNAIL_SIZE, batch.THUMBNAIL_SIZE))
+        self.verticalHeader().setDefaultSectionSize(batch.THUMBNAIL_SIZE + 4)
+        self.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+
+        for row, result in enumerate(report["results"]):
+            for column, filename in enumerate(result.get("thumbnails", [])):
+                item = qt.QTableWidgetItem()
+                item.setData(
+                    qt.Qt.DecorationRole,
+                    qt.QPixmap(os.path.join(report_dir, filename)),
+                )
+                self.setItem(row, column, item)
+            name = qt.QTableWidgetItem(os.path.basename(result["file1"]))
+            name.setData(qt.Qt.UserRole, row)
+            self.setItem(row, 3, name)
+            diff = qt.QTableWidgetItem(result.get("error", ""))
+            if "max_diff" in result:
+                # Store as a number so sorting is numeric
+                diff.setData(qt.Qt.DisplayRole, result["max_diff"])
+            self.setItem(row, 4, diff)
+
+        self.resizeColumnsToContents()
+        self.setSortingEnabled(True)
+        self.sortItems(4, qt.Qt.DescendingOrder)
+        self.cellDoubleClicked.connect(self._open)
+
+    def _open(self, row, column):
+        index = self.item(row, 3).data(qt.Qt.UserRole)
+        result = self._report["results"][index]
+        if "error" in result:
+            return
+
+        if index not in self._viewers:
+            images = Images(result["file1"], result["file2"], **self._report["options"])
+            window = viewer_window(images)
+            window.setWindowTitle(os.path.basename(result["file1"]))
+            # Free the decoded images when the window is closed
+            window.setAttribute(qt.Qt.WA_DeleteOnClose)
+            window.destroyed.connect(lambda: self._viewers.pop(index, None))
+            self._viewers[index] = window
+        window = self._viewers[index]
+        window.showMaximized()
+        window.raise_()
+        window.activateWindow()
+
+
+def images_differ(images, threshold=None):
+    """True if images differ, by mean perceptual error if a threshold is
+    given, or by any difference at all otherwise."""
+    if not images.has_diff:
+        return False
+    if threshold is not None:
+        return images.metrics["Perceptual"] > threshold
+    return images.max_diff != 0
+
+
+def console_diff(images, regions=0, threshold=None):
+    if not images_differ(images, threshold):
+        return 0
+
+    if images.offset is not None:
+        print(f"Alignment offset: {images.offset[0]:g}, {images.offset[1]:g}")
+    print(f"Maximum diff: {images.max_diff}")
+    channel_max = images.channel_max_diff
+    print(
+        "Maximum diff per channel: "
+        + ", ".join(f"{c} {channel_max[c]:g}" for c in "RGBA")
+    )
+    for name, value in images.metrics.items():
+        print(f"{name}: {value:g}")
+    for (x, y, width, height), diff in images.worst_regions(regions):
+        print(f"  {width} x {height} at {x}, {y + images.row_offset}: {diff:g}")
+    return 1
+
+
+def result_differs(result, threshold=None):
+    """Like images_differ, for a result from a batch report."""
+    if threshold is not None:
+        return result["metrics"]["Perceptual"] > threshold
+    return result["max_diff"] != 0
+
+
+def console_batch(report, threshold=None):
+    status = 0
+    # Like diff -r
+    for path in report.get("unmatched", []):
+        print(f"Only in {os.path.dirname(path)}: {os.path.basename(path)}")
+        status = 1
+    for result in report["results"]:
+        name = os.path.basename(result["file1"])
+        if "error" in result:
+            print(f"{name}: {result['error']}")
+            status = 1
+        elif result_differs(result, threshold):
+            print(f"{name}: maximum diff {result['max_diff']:g}")
+            status = 1
+    return status
+
+
+def get_report(args, options):
+    """Load an existing batch report, or compare two directories.
+
+    Returns (report directory, report). Raises ValueError if a threshold
+    is given for a report that was made without metrics.
+    """
+    if not args.file2 and batch.is_report(args.file1):
+        report = batch.load_report(args.file1)
+        if args.threshold is not None and not report["options"].get("with_metrics"):
+            raise ValueError(
+                f"{args.file1}: report has no metrics to compare to the threshold"
+            )
+        if args.export:
+            batch.export_report(report, args.export, args.fps)
+        return args.file1, report
+
+    pairs, unmatched = batch.find_pairs(args.file1, args.file2)
+    return args.report, batch.run_batch(
+        pairs,
+        args.report,
+        export_filename=args.export,
+        fps=args.fps,
+        unmatched=unmatched,
+        **options,
+    )
+
+
+def row_range(text):
+    """Parse a FIRST:LAST scanline range."""
+    try:
+        first, last = (int(i) for i in text.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected FIRST:LAST, got {text!r}")
+    if first > last:
+        raise argparse.ArgumentTypeError(f"FIRST must not be after LAST in {text}")
+    return first, last
+
+
+def get_file2(args):
+    # With hdrdiff <file> <dir>, look for a matching filename in the
+    # directory (like normal diff)
+    if args.file2 and os.path.isdir(args.file2):
+        return os.path.join(args.file2, os.path.basename(args.file1))
+    else:
+        return args.file2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file1")
+    parser.add_argument("file2", nargs="?")
+    parser.add_argument(
+        "-n", "--no-gui", help="Print diff information and exit.", action="store_true"
+    )
+    parser.add_argument(
+        "-x",
+        "--exit-if-same",
+        help="Only show GUI if images differ.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-r",
+        "--regions",
+        help="With --no-gui, print the N regions with the largest diffs.",
+        type=int,
+        default=5,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--rows",
+        help="Only load scanlines FIRST to LAST (inclusive). For EXRs, only "
+        "the data for those scanlines is read from disk.",
+        type=row_range,
+        metavar="FIRST:LAST",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        help="Compute SSIM, PSNR and perceptual error.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        help="Treat images as the same if the mean perceptual error is at most T "
+        "(implies --metrics).",
+        type=float,
+        metavar="T",
+    )
+    parser.add_argument(
+        "-a",
+        "--align",
+        help="Align the second image to the first by whole pixels before diffing.",
+        action="store_const",
+        const="integer",
+    )
+    parser.add_argument(
+        "--align-subpixel",
+        help="Align the second image to the first with sub-pixel precision.",
+        action="store_const",
+        const="subpixel",
+        dest="align",
+    )
+    parser.add_argument(
+        "--report",
+        help="With two directories, compare all matching files and write "
+        "thumbnails and a report to DIR. Pass DIR as the only argument to "
+        "review the results again.",
+        default="hdrdiff-report",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "-e",
+        "--export",
+        help="Write normalized left, right and diff images to PATH, with "
+        "suffixes added. For directories, PATH may also be a .mp4 or .avi "
+        "video with a frame for each pair.",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--fps",
+        help="Frame rate of exported videos.",
+        type=float,
+        default=24,
+    )
+    args = parser.parse_args()
+
+    options = dict(
+        rows=args.rows,
+        with_metrics=args.metrics or args.threshold is not None,
+        alignment=args.align,
+    )
+    if args.export:
+        try:
+            export.check_filename(args.export, allow_video=os.path.isdir(args.file1))
+        except ValueError as e:
+            parser.error(str(e))
+
+    if os.path.isdir(args.file1):
+        if args.file2 is None and not batch.is_report(args.file1):
+            parser.error(f"{args.file1} is not a report directory")
+        if args.file2 is not None and not os.path.isdir(args.file2):
+            parser.error(f"{args.file2} is not a directory")
+        try:
+            report_dir, report = get_report(args, options)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.no_gui:
+            sys.exit(console_batch(report, args.threshold))
+
+        app = qt.QApplication([])
+        window = ReviewWindow(report, report_dir)
+    else:
+        images = Images(args.file1, get_file2(args), **options)
+        if args.export:
+            export.export_images(images, args.export)
+        if args.no_gui:
+            sys.exit(console_diff(images, args.regions, args.threshold))
+        if (
+            args.exit_if_same
+            and images.has_diff
+            and not images_differ(images, args.threshold)
+        ):
+            sys.exit(0)
+
+        app = qt.QApplication([])
+        window = viewer_window(images)
 
     # Run the app
     window.showMaximized()
@@ -1,5 +1,7 @@
 import enable_exr  # noqa: F401
+import align
 import cv2
+import metrics
 import numpy
 import qt
 import OpenEXR
@@ -14,18 +16,66 @@ def _qimage_from_rgba(image):
     return qt.QImage(bits, width, height, width * 4, qt.QImage.Format_RGB32).copy()
 
 
-def _qimage_from_channel(image, index):
-    height, width = image.shape[:2]
-    # Transpose to make planar images, and select the channel we want
-    channel = image.T[index]
-    # Make a 4-channel image and transpose again to pack the pixels
-    packed = numpy.array([channel, channel, channel, channel]).T
+def _qimage_from_channel(channel):
+    # Display a single plane as grayscale, so no packing is needed
+    height, width = channel.shape
+    bits = (numpy.clip(channel, 0, 1) * 255).astype(numpy.uint8).tobytes()
+    return qt.QImage(bits, width, height, width, qt.QImage.Format_Grayscale8).copy()
+
+
+def _clip_rows(filename, rows, height):
+    """Clip a (first, last) scanline range to an image's height."""
+    if rows is None:
+        return 0, height - 1
+    first, last = max(0, rows[0]), min(height - 1, rows[1])
+    if last < first:
+        raise ValueError(f"{filename}: no scanlines in range {rows}")
+    return first, last
+
+
+def _read_exr(filename, rows=None):
+    """Read an EXR with OpenEXR, returning (BGRA image, channels).
+
+    If rows is a (first, last) pair of scanlines (inclusive, relative
+    to the top of the data window), only the chunks or tiles containing
+    those scanlines are read and decoded.
+    """
+    f = OpenEXR.InputFile(filename)
+    header = f.header()
+    window = header["dataWindow"]
+    width = window.max.x - window.min.x + 1
+    first, last = _clip_rows(filename, rows, window.max.y - window.min.y + 1)
+
+    names = set(header["channels"].keys())
+    try:
+        channels = next(c for c in ["RGBA", "RGB", "A", "Y"] if set(c) <= names)
+    except StopIteration:
+        raise ValueError(f"{filename}: unsupported channels {sorted(names)}")
+
+    planes = [
+        numpy.frombuffer(p, numpy.float32).reshape(last - first + 1, width)
+        for p in f.channels(
+            list(channels),
+            Imath.PixelType(OpenEXR.FLOAT),
+            window.min.y + first,
+            window.min.y + last,
+        )
+    ]
+    if len(planes) == 1:
+        # Single-channel images are treated as alpha, as with OpenCV
+        return cv2.cvtColor(planes[0], cv2.COLOR_GRAY2BGRA), "A"
+    # Reorder to BGR(A)
+    img = cv2.merge(planes[2::-1] + planes[3:])
+    if channels == "RGB":
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+    return img, channels
 
-    bits = (numpy.clip(packed, 0, 1) * 255).astype(numpy.uint8).tobytes()
-    return qt.QImage(bits, width, height, width * 4, qt.QImage.Format_RGB32).copy()
 
+def _read_image(filename, rows=None):
+    if rows is not None and OpenEXR.isOpenExrFile(filename):
+        # Only read the scanlines we need
+        return _read_exr(filename, rows)
 
-def _read_image(filename):
     img = cv2.imread(
         filename,
         cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH | cv2.IMREAD_UNCHANGED,
@@ -33,20 +83,7 @@ def _read_image(filename):
     if img is None:
         # OpenCV won't read alpha-only EXRs, so use OpenEXR
         # directly.
-        f = OpenEXR.InputFile(filename)
-        assert list(f.header()["channels"].keys()) == ["A"]
-        # Get the channel (assume it's alpha for now), and turn into a
-        # numpy array
-        window = f.header()["dataWindow"]
-        width = window.max.x - window.min.x + 1
-        height = window.max.y - window.min.y + 1
-        alpha = numpy.ndarray(
-            (height, width),
-            numpy.float32,
-            f.channel("A", Imath.PixelType(OpenEXR.FLOAT)),
-        )
-        # Convert to BGRA
-        return cv2.cvtColor(alpha, cv2.COLOR_GRAY2BGRA), "A"
+        return _read_exr(filename)
     elif len(img.shape) == 2:
         # A luma-only EXR (Y channel), is read as a 2D array
         channels = "A"
@@ -57,6 +94,11 @@ def _read_image(filename):
     else:
         channels = "RGBA"
 
+    if rows is not None:
+        # Other formats must be decoded in full, then cropped
+        first, last = _clip_rows(filename, rows, img.shape[0])
+        img = img[slice(first, last + 1)]
+
     if img.dtype == numpy.uint8:
         return (img / 255.0).astype(numpy.float32), channels
     else:
@@ -81,37 +123,139 @@ def _pad_images(images):
     ]
 
 
+def _block_index(diff, block_size):
+    """Per-tile, per-channel maximum of diff.
+
+    Returns a (rows, columns, channels) array with one entry per
+    block_size x block_size tile (partial tiles at the right and bottom
+    edges are included).
+    """
+    height, width = diff.shape[:2]
+    rows = numpy.maximum.reduceat(diff, numpy.arange(0, height, block_size), axis=0)
+    return numpy.maximum.reduceat(rows, numpy.arange(0, width, block_size), axis=1)
+
+
 class Images(qt.QObject):
     imageChanged = qt.Signal(qt.QImage)
+    BLOCK_SIZE = 32
+
+    def __init__(
+        self, file1, file2=None, rows=None, with_metrics=False, alignment=None, **kwargs
+    ):
+        """Load and diff images.
 
-    def __init__(self, file1, file2=None, **kwargs):
+        alignment may be "integer" or "subpixel" to shift the second
+        image to match the first before diffing.
+        """
         super().__init__(**kwargs)
 
         raw_images, self.descriptions = list(
-            zip(*[_read_image(f) for f in [file1, file2] if f])
+            zip(*[_read_image(f, rows) for f in [file1, file2] if f])
         )
+        # Row of the original files at the top of the loaded images.
+        # Internal coordinates are relative to this; add it back when
+        # reporting positions.
+        self.row_offset = max(0, rows[0]) if rows else 0
         self.image_dims = [(i.shape[1], i.shape[0]) for i in raw_images]
         self.cv_images = _pad_images(raw_images)
         self.image_names = [os.path.basename(file1)]
+        # Offset (dx, dy) of the second image, if it was aligned
+        self.offset = None
+        if len(self.cv_images) == 2 and alignment:
+            self._align(alignment == "subpixel")
         if len(self.cv_images) == 2:
             self.cv_images.append(numpy.abs(self.cv_images[0] - self.cv_images[1]))
+            blocks = _block_index(self.cv_images[2], self.BLOCK_SIZE)
+            self.diff_blocks = numpy.max(blocks, axis=2)
+            # Maximum diff of each channel, by name
+            self.channel_max_diff = dict(zip("BGRA", numpy.max(blocks, axis=(0, 1))))
             self.image_names.extend([os.path.basename(file2), "Diff"])
             self.descriptions += (f"max {self.max_diff:g}",)
 
+        # Summary values of optional metrics, by name
+        self.metrics = {}
+        if self.has_diff and with_metrics:
+            self._add_metrics()
+
+        # Planar (channel, row, column) copies of cv_images, made on demand
+        self._planar = {}
         self._selected_image = 0
         self._channel = None
-        self._scale = [1.0] * 3
-        self._offset = [0.0] * 3
+        # Always include left, right and diff, even for a single image
+        views = max(3, len(self.cv_images))
+        self._scale = [1.0] * views
+        self._offset = [0.0] * views
         self._update_image()
 
+    def _align(self, subpixel):
+        self.offset = align.estimate_offset(*self.cv_images, subpixel=subpixel)
+        dx, dy = self.offset
+        if dx == dy == 0:
+            return
+        self.cv_images[1] = align.shift(self.cv_images[1], (-dx, -dy))
+        self.descriptions = (
+            self.descriptions[0],
+            f"{self.descriptions[1]}, shifted by {-dx:g}, {-dy:g}",
+        )
+
+    def _add_error_view(self, name, error, description):
+        """Add a single-channel error map as an extra diff view.
+
+        The map is stored as a 2D array, and treated as a single
+        channel when displayed.
+        """
+        self.cv_images.append(error)
+        self.image_names.append(name)
+        self.descriptions += (description,)
+
+    def _add_metrics(self):
+        left, right = self.cv_images[:2]
+        ssim = metrics.ssim_map(left, right)
+        perceptual = metrics.perceptual_map(left, right)
+        self.metrics = {
+            "SSIM": float(numpy.mean(ssim)),
+            "PSNR": metrics.psnr(left, right),
+            "Perceptual": float(numpy.mean(perceptual)),
+        }
+        self._add_error_view(
+            "SSIM Error", 1 - ssim, f"mean SSIM {self.metrics['SSIM']:g}"
+        )
+        self._add_error_view(
+            "Perceptual Error",
+            perceptual,
+            f"mean {self.metrics['Perceptual']:g}, PSNR {self.metrics['PSNR']:g} dB",
+        )
+
+    def planar(self, index):
+        """Return image index as contiguous planes, in BGRA order.
+
+        Single-channel operations on the result scan contiguous memory
+        rather than striding through interleaved pixels. The planar copy
+        is made the first time it is needed, then cached.
+        """
+        if index not in self._planar:
+            self._planar[index] = numpy.ascontiguousarray(
+                self.cv_images[index].transpose(2, 0, 1)
+            )
+        return self._planar[index]
+
+    def _channels(self, index):
+        """Data for the current channel (or all channels) of an image.
+
+        Single-plane error views are returned as they are, whatever the
+        channel.
+        """
+        if self._channel is None or self.cv_images[index].ndim == 2:
+            return self.cv_images[index]
+        return self.planar(index)["BGRA".index(self._channel)]
+
     def _update_image(self):
         i = self._selected_image
-        image = self.cv_images[i] * self._scale[i] + self._offset[i]
-        if self._channel is None:
+        image = self._channels(i) * self._scale[i] + self._offset[i]
+        if image.ndim == 3:
             self.qimage = _qimage_from_rgba(image)
         else:
-            index = "BGRA".index(self._channel)
-            self.qimage = _qimage_from_channel(image, index)
+            self.qimage = _qimage_from_channel(image)
         self.imageChanged.emit(self.qimage)
 
     def view_channel(self, name):
@@ -130,24 +274,43 @@ class Images(qt.QObject):
         self._offset[0] = self._offset[1] = value
         self._update_image()
 
+    def normalization(self):
+        """Return the (scale, offset) mapping images (or the current
+        channel) to [0, 1]."""
+        images = [self._channels(i) for i in range(min(3, len(self.cv_images)))]
+        low = min(numpy.min(i) for i in images)
+        high = max(numpy.max(i) for i in images)
+        scale = 1.0 / (high - low)
+        return scale, -1 * scale * low
+
     def normalize(self):
-        low = min(numpy.min(i) for i in self.cv_images)
-        high = max(numpy.max(i) for i in self.cv_images)
-        self._scale[0] = self._scale[1] = 1.0 / (high - low)
-        self._offset[0] = self._offset[1] = -1 * self._scale[0] * low
+        scale, offset = self.normalization()
+        self._scale[0] = self._scale[1] = scale
+        self._offset[0] = self._offset[1] = offset
         self._update_image()
         return self._scale[0], self._offset[0]
 
     def set_diff_scale(self, value):
-        self._scale[2] = value
+        # Diff scale is shared by the diff and any error views
+        self._scale[2:] = [value] * len(self._scale[2:])
         self._update_image()
 
+    def diff_normalization(self):
+        """Return the scale mapping the selected diff view (or the diff,
+        if an image is selected) to [0, 1], using the current channel if
+        there is one."""
+        i = self._selected_image if self._selected_image > 2 else 2
+        if i == 2 and self._channel is None:
+            high = self.max_diff
+        else:
+            high = numpy.max(self._channels(i))
+        return 1.0 / high
+
     def normalize_diff(self):
         if len(self.cv_images) < 3:
             return 1.0
 
-        self._scale[2] = 1.0 / self.max_diff
-        self._update_image()
+        self.set_diff_scale(self.diff_normalization())
         return self._scale[2]
 
     def select_image(self, index):
@@ -160,10 +323,72 @@ class Images(qt.QObject):
     def selected_image(self):
         return self._selected_image
 
+    @property
+    def channel(self):
+        """Name of the channel being viewed, or None for all channels."""
+        return self._channel
+
+    def contains(self, x, y):
+        """True if (x, y) is inside any of the loaded images."""
+        return any(0 <= x < w and 0 <= y < h for w, h in self.image_dims)
+
+    def sample(self, index, points):
+        """Return pixels of an image at (x, y) points, as an (n, 4) BGRA array.
+
+        Points outside the image give zeros.
+        """
+        image = self.cv_images[index]
+        height, width = image.shape[:2]
+        x, y = numpy.asarray(points, dtype=int).reshape(-1, 2).T
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        pixels = numpy.zeros((len(x), 4), image.dtype)
+        values = image[y[inside], x[inside]]
+        if image.ndim == 2:
+            # Single-plane error views have the same value in every channel
+            values = values[:, numpy.newaxis]
+        pixels[inside] = values
+        return pixels
+
     @property
     def max_diff(self):
-        return numpy.max(self.cv_images[2])
+        return numpy.max(self.diff_blocks)
+
+    def block_rect(self, row, col):
+        """Image-space (x, y, width, height) of a tile in diff_blocks."""
+        height, width = self.cv_images[2].shape[:2]
+        x = col * self.BLOCK_SIZE
+        y = row * self.BLOCK_SIZE
+        return (
+            x,
+            y,
+            min(self.BLOCK_SIZE, width - x),
+            min(self.BLOCK_SIZE, height - y),
+        )
+
+    def worst_regions(self, count):
+        """Return up to count (rect, max diff) pairs for differing tiles.
+
+        Tiles are sorted by decreasing diff, and tiles with no
+        difference are omitted.
+        """
+        if not self.has_diff:
+            return []
+        flat = self.diff_blocks.ravel()
+        count = min(count, numpy.count_nonzero(flat))
+        if count == 0:
+            return []
+        # Partial sort to find the worst tiles, then order just those
+        worst = numpy.argpartition(flat, -count)[-count:]
+        worst = worst[numpy.argsort(flat[worst])[::-1]]
+        cols = self.diff_blocks.shape[1]
+        return [(self.block_rect(i // cols, i % cols), flat[i]) for i in worst]
+
+    def differing_blocks(self):
+        """Return rects of all tiles with a nonzero diff."""
+        if not self.has_diff:
+            return []
+        return [self.block_rect(r, c) for r, c in zip(*self.diff_blocks.nonzero())]
 
     @property
     def has_diff(self):
-        return len(self.cv_images) == 3
+        return len(self.cv_images) >= 3
@@ -0,0 +1,114 @@
+"""Image quality metrics for comparing HDR images.
+
+All functions take BGRA float images as stored by Images. SSIM and the
+perceptual error work on tonemapped values, so they behave sensibly for
+HDR data. Filtering is done in strips of rows to keep memory use bounded
+on large frames.
+"""
+
+import enable_exr  # noqa: F401
+import cv2
+import numpy
+
+# Rows processed at once by the filtered metrics
+CHUNK_ROWS = 256
+
+# SSIM uses an 11x11 Gaussian window with sigma 1.5
+SSIM_SIGMA = 1.5
+SSIM_RADIUS = 5
+SSIM_C1 = 0.01**2
+SSIM_C2 = 0.03**2
+
+# Blur applied before the perceptual error, roughly modelling the loss
+# of contrast sensitivity at high spatial frequencies
+PERCEPTUAL_SIGMA = 1.0
+PERCEPTUAL_RADIUS = 3
+
+# Rec. 709 luminance weights, in BGR order
+LUMINANCE = numpy.array([0.0722, 0.7152, 0.2126], numpy.float32)
+
+
+def _tonemap(image):
+    """Map linear BGR values into [0, 1) with a Reinhard curve."""
+    bgr = numpy.maximum(image[..., :3], 0)
+    return bgr / (1 + bgr)
+
+
+def _blur(image, sigma, radius):
+    size = 2 * radius + 1
+    return cv2.GaussianBlur(image, (size, size), sigma)
+
+
+def _strips(height, halo):
+    """Yield (y0, y1, h0, h1) for each strip of rows.
+
+    Rows y0:y1 of the output are computed from input rows h0:h1, which
+    include enough extra rows for the filter to match a full-frame
+    result.
+    """
+    for y0 in range(0, height, CHUNK_ROWS):
+        y1 = min(y0 + CHUNK_ROWS, height)
+        yield y0, y1, max(0, y0 - halo), min(height, y1 + halo)
+
+
+def _filtered_map(a, b, halo, strip_function):
+    result = numpy.empty(a.shape[:2], numpy.float32)
+    for y0, y1, h0, h1 in _strips(a.shape[0], halo):
+        strip = strip_function(a[h0:h1], b[h0:h1])
+        result[y0:y1] = strip[slice(y0 - h0, y1 - h0)]
+    return result
+
+
+def _ssim_strip(a, b):
+    x = _tonemap(a) @ LUMINANCE
+    y = _tonemap(b) @ LUMINANCE
+
+    def blur(i):
+        return _blur(i, SSIM_SIGMA, SSIM_RADIUS)
+
+    mx, my = blur(x), blur(y)
+    mxx, myy, mxy = mx * mx, my * my, mx * my
+    sxx = blur(x * x) - mxx
+    syy = blur(y * y) - myy
+    sxy = blur(x * y) - mxy
+    return ((2 * mxy + SSIM_C1) * (2 * sxy + SSIM_C2)) / (
+        (mxx + myy + SSIM_C1) * (sxx + syy + SSIM_C2)
+    )
+
+
+def _perceptual_strip(a, b):
+    x = _blur(_tonemap(a), PERCEPTUAL_SIGMA, PERCEPTUAL_RADIUS)
+    y = _blur(_tonemap(b), PERCEPTUAL_SIGMA, PERCEPTUAL_RADIUS)
+    return numpy.sqrt(numpy.sum((x - y) ** 2, axis=2) / 3)
+
+
+def ssim_map(a, b):
+    """Per-pixel SSIM of the luminance of two images."""
+    return _filtered_map(a, b, SSIM_RADIUS, _ssim_strip)
+
+
+def perceptual_map(a, b):
+    """Per-pixel perceptual error, from 0 (identical) to 1.
+
+    This is a simplified FLIP-style metric: both images are tonemapped,
+    blurred, and compared by RGB distance.
+    """
+    return _filtered_map(a, b, PERCEPTUAL_RADIUS, _perceptual_strip)
+
+
+def psnr(a, b):
+    """Peak signal-to-noise ratio in dB, over the RGB channels.
+
+    The peak is the maximum value of the first image, so HDR images are
+    handled without clipping.
+    """
+    squared_error = 0.0
+    peak = 0.0
+    for y0, y1, _, _ in _strips(a.shape[0], 0):
+        diff = a[y0:y1, :, :3] - b[y0:y1, :, :3]
+        squared_error += float(numpy.sum(numpy.square(diff, dtype=numpy.float64)))
+        peak = max(peak, float(numpy.max(a[y0:y1, :, :3], initial=0)))
+    mse = squared_error / (a.shape[0] * a.shape[1] * 3)
+    if mse == 0:
+        return float("inf")
+    return 10 * numpy.log10((peak or 1.0) ** 2 / mse)
@@ -1,5 +1,15 @@
+import argparse
+import os
+import shutil
+import tempfile
 import unittest
 import qt
+import align
+import batch
+import cv2
+import export
+import hdrdiff
+import metrics
 import numpy
 from images import Images
 from transform import fit, scale_factor, zoom
@@ -138,3 +148,334 @@ class TestImageImport(unittest.TestCase):
         images = Images("test-images/256/rgba.exr", "test-images/1920/rgba.exr")
         self.assertEqual(images.cv_images[0].shape, (1275, 1920, 4))
         self.assertEqual(images.cv_images[1].shape, (1275, 1920, 4))
+
+
+class TestSingleImage(unittest.TestCase):
+    def test_scale_and_normalize(self):
+        images = Images("test-images/256/rgb.exr")
+        images.set_scale(2.0)
+        images.set_offset(0.5)
+        scale, offset = images.normalize()
+        image = images.cv_images[0]
+        self.assertAlmostEqual(image.min() * scale + offset, 0, places=5)
+        self.assertAlmostEqual(image.max() * scale + offset, 1, places=5)
+
+
+class TestDiffBlocks(unittest.TestCase):
+    def test_block_index(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/rgba.exr")
+        diff = images.cv_images[2]
+        # 256 x 170, so the bottom row of tiles is partial
+        self.assertEqual(images.diff_blocks.shape, (6, 8))
+        self.assertEqual(images.max_diff, numpy.max(diff))
+        self.assertEqual(images.diff_blocks[1, 2], numpy.max(diff[32:64, 64:96]))
+        self.assertEqual(images.diff_blocks[5, 7], numpy.max(diff[160:, 224:]))
+
+    def test_channel_max_diff(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/8bit.png")
+        diff = images.cv_images[2]
+        for i, c in enumerate("BGRA"):
+            self.assertEqual(images.channel_max_diff[c], numpy.max(diff[..., i]))
+
+    def test_worst_regions(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/rgba.exr")
+        regions = images.worst_regions(3)
+        self.assertEqual(regions[0][1], images.max_diff)
+        self.assertEqual(
+            [d for _, d in regions], sorted((d for _, d in regions), reverse=True)
+        )
+
+    def test_no_diff(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/rgb.exr")
+        self.assertEqual(images.worst_regions(3), [])
+        self.assertEqual(images.differing_blocks(), [])
+
+
+class TestPartialRead(unittest.TestCase):
+    def test_exr_rows(self):
+        full = Images("test-images/256/rgba.exr").cv_images[0]
+        part = Images("test-images/256/rgba.exr", rows=(10, 41)).cv_images[0]
+        numpy.testing.assert_array_equal(part, full[10:42])
+
+    def test_rows_clipped_to_image(self):
+        part = Images("test-images/256/rgb.exr", rows=(160, 500)).cv_images[0]
+        self.assertEqual(part.shape, (10, 256, 4))
+
+    def test_other_formats_cropped(self):
+        full = Images("test-images/256/8bit.png").cv_images[0]
+        part = Images("test-images/256/8bit.png", rows=(5, 9)).cv_images[0]
+        numpy.testing.assert_array_equal(part, full[5:10])
+
+    def test_row_offset(self):
+        images = Images("test-images/256/8bit.png", rows=(100, 169))
+        self.assertEqual(images.row_offset, 100)
+        self.assertEqual(Images("test-images/256/8bit.png").row_offset, 0)
+
+    def test_row_range(self):
+        self.assertEqual(hdrdiff.row_range("10:50"), (10, 50))
+        for text in ["50:10", "abc", "1:2:3"]:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                hdrdiff.row_range(text)
+
+    def test_rows_out_of_range(self):
+        for filename in ["test-images/256/rgb.exr", "test-images/256/8bit.png"]:
+            with self.assertRaises(ValueError):
+                Images(filename, rows=(200, 300))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_identical(self):
+        images = Images(
+            "test-images/256/rgb.exr", "test-images/256/rgb.exr", with_metrics=True
+        )
+        self.assertAlmostEqual(images.metrics["SSIM"], 1.0, places=5)
+        self.assertEqual(images.metrics["PSNR"], float("inf"))
+        self.assertEqual(images.metrics["Perceptual"], 0.0)
+
+    def test_error_views(self):
+        images = Images(
+            "test-images/256/rgb.exr", "test-images/256/8bit.png", with_metrics=True
+        )
+        self.assertEqual(images.image_names[3:], ["SSIM Error", "Perceptual Error"])
+        # Error maps are stored as single planes
+        self.assertEqual(images.cv_images[3].shape, images.cv_images[2].shape[:2])
+        self.assertEqual(images.cv_images[4].shape, images.cv_images[2].shape[:2])
+        error = images.cv_images[4][20, 10]
+        numpy.testing.assert_array_equal(images.sample(4, [(10, 20)]), [[error] * 4])
+        self.assertLess(images.metrics["SSIM"], 1.0)
+
+    def test_chunked(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/8bit.png")
+        left, right = images.cv_images[:2]
+        full = metrics.ssim_map(left, right), metrics.perceptual_map(left, right)
+        old_rows = metrics.CHUNK_ROWS
+        metrics.CHUNK_ROWS = 16
+        try:
+            chunked = metrics.ssim_map(left, right), metrics.perceptual_map(left, right)
+        finally:
+            metrics.CHUNK_ROWS = old_rows
+        for f, c in zip(full, chunked):
+            numpy.testing.assert_allclose(f, c, atol=1e-6)
+
+
+class TestAlign(unittest.TestCase):
+    def test_estimate_offset(self):
+        image = Images("test-images/1920/8bit.png").cv_images[0]
+        for offset in [(0, 0), (3, -2), (-1, 5)]:
+            shifted = align.shift(image, offset)
+            self.assertEqual(align.estimate_offset(image, shifted), offset)
+
+    def test_noisy_low_texture(self):
+        # Upscaling leaves large flat areas, where noise dominates
+        image = Images("test-images/1920/8bit.png").cv_images[0]
+        image = cv2.resize(image, (3840, 2160), interpolation=cv2.INTER_LINEAR)
+        random = numpy.random.default_rng(0)
+        for offset in [(0, 1), (2, -1)]:
+            a, b = (
+                (i + random.normal(0, 0.05, i.shape)).astype(numpy.float32)
+                for i in (image, align.shift(image, offset))
+            )
+            self.assertEqual(align.estimate_offset(a, b), offset)
+            self.assertEqual(align.estimate_offset(a * 50, b * 50), offset)
+
+    def test_reject_unrelated(self):
+        random = numpy.random.default_rng(0)
+        a, b = (random.random((500, 500, 4), numpy.float32) for _ in range(2))
+        self.assertEqual(align.estimate_offset(a, b), (0, 0))
+
+    def test_reject_large_offset(self):
+        image = Images("test-images/1920/8bit.png").cv_images[0]
+        shifted = align.shift(image, (align.MAX_OFFSET + 10, 0))
+        self.assertEqual(align.estimate_offset(image, shifted), (0, 0))
+
+    def test_unshifted_hdr(self):
+        # Bright HDR values shouldn't produce a spurious shift
+        images = Images(
+            "test-images/256/rgb.exr", "test-images/256/8bit.png", alignment="integer"
+        )
+        self.assertEqual(images.offset, (0, 0))
+
+    def test_too_small(self):
+        images = Images(
+            "test-images/256/rgb.exr",
+            "test-images/256/rgba.exr",
+            rows=(0, 0),
+            alignment="integer",
+        )
+        self.assertEqual(images.offset, (0, 0))
+
+    def test_aligned_diff(self):
+        images = Images(
+            "test-images/1920/8bit.png",
+            "test-images/1920/8bit.png",
+            alignment="integer",
+        )
+        self.assertEqual(images.offset, (0, 0))
+        self.assertEqual(images.max_diff, 0)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        for d in ["a", "b"]:
+            os.mkdir(os.path.join(self.dir, d))
+            for f in ["rgb.exr", "8bit.png"]:
+                shutil.copy(f"test-images/256/{f}", os.path.join(self.dir, d, f))
+        shutil.copy("test-images/256/rgba.exr", os.path.join(self.dir, "a"))
+
+    def test_find_pairs(self):
+        a, b = (os.path.join(self.dir, d) for d in ["a", "b"])
+        self.assertEqual(
+            batch.find_pairs(a, b),
+            (
+                [
+                    (os.path.join(a, "8bit.png"), os.path.join(b, "8bit.png")),
+                    (os.path.join(a, "rgb.exr"), os.path.join(b, "rgb.exr")),
+                ],
+                [os.path.join(a, "rgba.exr")],
+            ),
+        )
+
+    def test_run_batch(self):
+        a, b = (os.path.join(self.dir, d) for d in ["a", "b"])
+        report_dir = os.path.join(self.dir, "report")
+        pairs, unmatched = batch.find_pairs(a, b)
+        report = batch.run_batch(pairs, report_dir, processes=2, unmatched=unmatched)
+        self.assertEqual(batch.load_report(report_dir), report)
+        self.assertEqual([r["max_diff"] for r in report["results"]], [0.0, 0.0])
+        self.assertEqual(report["unmatched"], unmatched)
+        # Unmatched files count as a difference
+        self.assertEqual(hdrdiff.console_batch(report), 1)
+        for result in report["results"]:
+            for filename in result["thumbnails"]:
+                self.assertTrue(os.path.isfile(os.path.join(report_dir, filename)))
+
+    def test_threshold_without_metrics(self):
+        a, b = (os.path.join(self.dir, d) for d in ["a", "b"])
+        report_dir = os.path.join(self.dir, "report")
+        batch.run_batch(batch.find_pairs(a, b)[0], report_dir, processes=1)
+        args = argparse.Namespace(
+            file1=report_dir, file2=None, threshold=0.01, export=None, fps=24
+        )
+        with self.assertRaises(ValueError):
+            hdrdiff.get_report(args, {})
+
+
+class TestPlanar(unittest.TestCase):
+    def test_planar(self):
+        images = Images("test-images/256/rgba.exr")
+        planar = images.planar(0)
+        self.assertTrue(planar.flags["C_CONTIGUOUS"])
+        numpy.testing.assert_array_equal(planar[2], images.cv_images[0][..., 2])
+        self.assertIs(images.planar(0), planar)
+
+    def test_normalize_channel(self):
+        images = Images("test-images/256/rgba.exr")
+        images.view_channel("G")
+        scale, offset = images.normalize()
+        green = images.cv_images[0][..., 1]
+        self.assertAlmostEqual(green.min() * scale + offset, 0, places=5)
+        self.assertAlmostEqual(green.max() * scale + offset, 1, places=5)
+
+
+class TestSample(unittest.TestCase):
+    def test_sample(self):
+        images = Images("test-images/256/rgba.exr")
+        image = images.cv_images[0]
+        pixels = images.sample(0, [(0, 0), (10, 20), (255, 169)])
+        numpy.testing.assert_array_equal(
+            pixels, [image[0, 0], image[20, 10], image[169, 255]]
+        )
+
+    def test_contains(self):
+        images = Images("test-images/256/rgb.exr")
+        self.assertTrue(images.contains(0, 0))
+        self.assertTrue(images.contains(255, 169))
+        self.assertFalse(images.contains(-1, 0))
+        self.assertFalse(images.contains(256, 0))
+        self.assertFalse(images.contains(0, 170))
+
+    def test_sample_outside(self):
+        images = Images("test-images/256/rgba.exr")
+        pixels = images.sample(0, [(-1, 0), (256, 0), (0, 170)])
+        numpy.testing.assert_array_equal(pixels, numpy.zeros((3, 4)))
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_normalized(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/8bit.png")
+        left, right, diff = export.normalized(images)
+        # As with normalize(), the range also covers the diff
+        self.assertGreaterEqual(min(left.min(), right.min()), -1e-6)
+        self.assertLessEqual(max(left.max(), right.max()), 1 + 1e-6)
+        self.assertAlmostEqual(diff.max(), 1, places=5)
+
+    def test_no_diff(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/rgb.exr")
+        diff = export.normalized(images)[2]
+        self.assertEqual(diff.max(), 0)
+
+    def test_export_images(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/8bit.png")
+        export.export_images(images, os.path.join(self.dir, "out.png"))
+        self.assertEqual(
+            sorted(os.listdir(self.dir)),
+            ["out-diff.png", "out-left.png", "out-right.png"],
+        )
+
+    def test_export_exr(self):
+        images = Images("test-images/256/rgba.exr", "test-images/256/rgb.exr")
+        export.export_images(images, os.path.join(self.dir, "out.exr"))
+        left = cv2.imread(os.path.join(self.dir, "out-left.exr"), cv2.IMREAD_UNCHANGED)
+        numpy.testing.assert_allclose(left, export.normalized(images)[0][..., :3])
+
+    def test_unsupported_format(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/8bit.png")
+        for filename in ["out.mp4", "out.xyz"]:
+            with self.assertRaises(ValueError):
+                export.export_images(images, os.path.join(self.dir, filename))
+
+    def test_missing_directory(self):
+        images = Images("test-images/256/rgb.exr", "test-images/256/8bit.png")
+        with self.assertRaises(ValueError):
+            export.export_images(images, os.path.join(self.dir, "missing", "out.png"))
+
+    def test_write_failed(self):
+        filename = os.path.join(self.dir, "missing", "out.png")
+        with self.assertRaises(RuntimeError):
+            export.imwrite(filename, numpy.zeros((16, 16, 3), numpy.uint8))
+
+    def test_batch_export_images(self):
+        pairs = [("test-images/256/rgb.exr", "test-images/256/8bit.png")]
+        report_dir = os.path.join(self.dir, "report")
+        batch.run_batch(
+            pairs, report_dir, export_filename=os.path.join(self.dir, "out.png")
+        )
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, "out-rgb-diff.png")))
+
+    def test_batch_export_video(self):
+        pairs = [("test-images/256/rgb.exr", "test-images/256/8bit.png")] * 3
+        report_dir = os.path.join(self.dir, "report")
+        filename = os.path.join(self.dir, "out.avi")
+        report = batch.run_batch(
+            pairs, report_dir, processes=2, export_filename=filename
+        )
+        video = cv2.VideoCapture(filename)
+        self.assertEqual(video.get(cv2.CAP_PROP_FRAME_COUNT), 3)
+        self.assertEqual(video.get(cv2.CAP_PROP_FRAME_WIDTH), 3 * 256)
+
+        # Export again from the saved report
+        os.remove(filename)
+        batch.export_report(report, filename)
+        video = cv2.VideoCapture(filename)
+        self.assertEqual(video.get(cv2.CAP_PROP_FRAME_COUNT), 3)
+
+    def test_video_writer_not_opened(self):
+        writer = export.VideoWriter(os.path.join(self.dir, "missing", "out.avi"), 24)
+        with self.assertRaises(RuntimeError):
+            writer.write(numpy.zeros((16, 16, 3), numpy.uint8))
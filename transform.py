@@ -20,6 +20,12 @@ def fit(item_dims, view_dims):
     return c1 * s * c2
 
 
+def fit_rect(rect, view_dims):
+    """Fit the (x, y, width, height) region of an item to view_dims."""
+    x, y, width, height = rect
+    return qt.QTransform.fromTranslate(-x, -y) * fit((width, height), view_dims)
+
+
 def zoom_to_scale(zoom_level):
     """Convert a zoom level to a scale factor.
 